@@ -52,19 +52,21 @@ def amplicon_lookup(PRIMER_BED,position,recurrence):
 def add_PCR_errors(df_amplicons,genome_abundances,PRIMER_BED,WUHAN_REF,AMPLICONS_FOLDER,U_SUBS_RATE,U_INS_RATE,U_DEL_RATE,
                     R_SUBS_RATE,R_INS_RATE,R_DEL_RATE,DEL_LENGTH_GEOMETRIC_PARAMETER,INS_MAX_LENGTH,
                     SUBS_VAF_DIRICLET_PARAMETER,INS_VAF_DIRICLET_PARAMETER,DEL_VAF_DIRICLET_PARAMETER,
-                    R_SUBS_VAF_DIRICLET_PARAMETER,R_INS_VAF_DIRICLET_PARAMETER,R_DEL_VAF_DIRICLET_PARAMETER):
+                    R_SUBS_VAF_DIRICLET_PARAMETER,R_INS_VAF_DIRICLET_PARAMETER,R_DEL_VAF_DIRICLET_PARAMETER,rng=None):
 
+    if rng is None:
+        rng = np.random.default_rng()
 
     REF=SeqIO.read(f"{WUHAN_REF}.fasta", format="fasta")
     VAF=dict(SUBS=SUBS_VAF_DIRICLET_PARAMETER,INS=INS_VAF_DIRICLET_PARAMETER,DEL=DEL_VAF_DIRICLET_PARAMETER)
     R_VAF=dict(SUBS=R_SUBS_VAF_DIRICLET_PARAMETER,INS=R_INS_VAF_DIRICLET_PARAMETER,DEL=R_DEL_VAF_DIRICLET_PARAMETER)
 
-    U_SUBS_COUNT=int(np.random.poisson(U_SUBS_RATE*len(REF.seq),1)) #unique
-    U_INS_COUNT=int(np.random.poisson(U_INS_RATE*len(REF.seq),1)) #unique
-    U_DEL_COUNT=int(np.random.poisson(U_DEL_RATE*len(REF.seq),1)) #unique
-    R_SUBS_COUNT=int(np.random.poisson(R_SUBS_RATE*len(REF.seq),1)) #recurrent
-    R_INS_COUNT=int(np.random.poisson(R_INS_RATE*len(REF.seq),1)) #recurrent
-    R_DEL_COUNT=int(np.random.poisson(R_DEL_RATE*len(REF.seq),1)) #recurrent
+    U_SUBS_COUNT=int(rng.poisson(U_SUBS_RATE*len(REF.seq),1)) #unique
+    U_INS_COUNT=int(rng.poisson(U_INS_RATE*len(REF.seq),1)) #unique
+    U_DEL_COUNT=int(rng.poisson(U_DEL_RATE*len(REF.seq),1)) #unique
+    R_SUBS_COUNT=int(rng.poisson(R_SUBS_RATE*len(REF.seq),1)) #recurrent
+    R_INS_COUNT=int(rng.poisson(R_INS_RATE*len(REF.seq),1)) #recurrent
+    R_DEL_COUNT=int(rng.poisson(R_DEL_RATE*len(REF.seq),1)) #recurrent
     SUBS_COUNT=U_SUBS_COUNT+R_SUBS_COUNT
     INS_COUNT=U_INS_COUNT+R_INS_COUNT
     DEL_COUNT=U_DEL_COUNT+R_DEL_COUNT
@@ -77,11 +79,11 @@ def add_PCR_errors(df_amplicons,genome_abundances,PRIMER_BED,WUHAN_REF,AMPLICONS
     errors["recurrence"]=["Recurrent"]*R_SUBS_COUNT+["Unique"]*U_SUBS_COUNT+["Recurrent"]*R_DEL_COUNT+["Unique"]*U_DEL_COUNT+["Recurrent"]*R_INS_COUNT+["Unique"]*U_INS_COUNT
     errors["genome"]=errors.apply(lambda x: random.choices(list(genome_abundances.keys()),weights=list(genome_abundances.values()) ,k=1) if x.recurrence=="Unique" else list(genome_abundances.keys()) , axis=1)
     errors["mut_indices"]=errors.index
-    errors["length"]=[1]*SUBS_COUNT + list(np.random.geometric(p=DEL_LENGTH_GEOMETRIC_PARAMETER, size=DEL_COUNT)) + random.choices(list(range(1,INS_MAX_LENGTH+1)),k=INS_COUNT) 
+    errors["length"]=[1]*SUBS_COUNT + list(rng.geometric(p=DEL_LENGTH_GEOMETRIC_PARAMETER, size=DEL_COUNT)) + random.choices(list(range(1,INS_MAX_LENGTH+1)),k=INS_COUNT) 
     errors["pos"]= random.sample(list(range(len(REF.seq))),k=SUBS_COUNT+INS_COUNT+DEL_COUNT)
     errors["ref"]=errors.apply(lambda x: REF.seq[x.pos] if x.errortype!="DEL" else REF.seq[x.pos-1:x.pos+x.length], axis=1)
     errors["alt"]=errors.apply(lambda x: alts(x.ref,x.errortype,x.length), axis=1)
-    errors["VAF"]=errors.apply(lambda x: np.random.dirichlet(VAF[x.errortype], size=None)[0] if x.recurrence=="Unique" else np.random.dirichlet(R_VAF[x.errortype], size=None)[0],axis=1)
+    errors["VAF"]=errors.apply(lambda x: rng.dirichlet(VAF[x.errortype], size=None)[0] if x.recurrence=="Unique" else rng.dirichlet(R_VAF[x.errortype], size=None)[0],axis=1)
     errors["amplicons"]=errors.apply(lambda x: amplicon_lookup(PRIMER_BED,x.pos,x.recurrence),axis=1)
     errors = errors.loc[errors['VAF']!=0,]
 
@@ -191,7 +193,7 @@ def add_PCR_errors(df_amplicons,genome_abundances,PRIMER_BED,WUHAN_REF,AMPLICONS
 
 
                     #How many reads this specific error will have
-                    mut_reads=np.random.binomial(i.n_reads , errors.loc[mut_idx,"VAF"])
+                    mut_reads=rng.binomial(i.n_reads , errors.loc[mut_idx,"VAF"])
 
                     #if number of reads and/or VAF are small, this can be 0
                     if mut_reads == 0:
@@ -277,8 +279,9 @@ def add_PCR_errors(df_amplicons,genome_abundances,PRIMER_BED,WUHAN_REF,AMPLICONS
 
                             #write the fasta file of the new amplicon. 
                             #Name all the PCR error combinations as _p1, _p2 and etc.
+                            #The file name has '/' escaped as '&', but the header (and so the read names) keeps the '/'.
                             with open(f"{AMPLICONS_FOLDER}/{new_path}","w") as new_a:
-                                new_a.write(f">{new_path[:-6]}\n")
+                                new_a.write(f">{new_path[:-6].replace('&', '/')}\n")
                                 new_a.write(new_seq + "\n\n")   
 
     #this is for optional VCF output.
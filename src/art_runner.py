@@ -1,32 +1,42 @@
 import shutil
 import subprocess
-import glob
 import os
-from os.path import basename, join
+from concurrent.futures import ProcessPoolExecutor
+from os.path import basename, dirname, join
 from io import StringIO
 import numpy as np
 from contextlib import contextmanager
-import string
+import threading
+import tempfile
 import logging
 
+# amplicon files needing fewer reads than this share art_illumina runs, to save the per-process overhead.
+SMALL_RCOUNT_THRESHOLD = 500
+
 
 class ArtIllumina:
 
-    def __init__(self, outpath, output_filename_prefix, read_length, seq_sys, verbose,temp, nreads):
+    def __init__(self, outpath, output_filename_prefix, read_length, seq_sys, verbose,temp, nreads, max_workers=None, compress=True, rng=None):
         self.outpath = outpath
         self.output_filename_prefix = output_filename_prefix
         self.read_length = read_length
         self.seq_sys = seq_sys
         self.verbose=verbose
         self.temp=temp
+        # every temporary file of the run goes in here, so tidying up is a single rmtree.
+        self.tmpdir=join(temp, "sms_run")
+        os.makedirs(self.tmpdir, exist_ok=True)
         self.nreads=nreads
+        self.max_workers=max_workers
+        self.compress=compress
+        self.rng=rng if rng is not None else np.random.default_rng()
 
     def run_once(self, infile, n_reads, out_prefix, rnd_seed):
 
         op = subprocess.run([
             "art_illumina", 
             "--amplicon",
-            #"--quiet",
+            "--quiet",
             "--paired",
             "--rndSeed", str(rnd_seed),
             "--noALN",
@@ -45,68 +55,212 @@ class ArtIllumina:
             # "--delRate2", str(0),    # Set deletion rate to 0
             # "--errfree",
 
-        ], capture_output=True)
+        ], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+        # only stderr is kept. It is returned rather than logged here, since this runs inside a worker process.
+        return op.stderr.decode("ASCII")
 
-        message_lines = op.stdout.decode("ASCII").split("\n")[-4:-2]
-        warning = op.stderr.decode("ASCII")
-        if self.verbose:
-            for line in message_lines:
-                logging.info("art_illumina: " + line)
-        if warning != "Warning: your simulation will not output any ALN or SAM file with your parameter settings!\n":
-            logging.warning(warning)
+    def _run_job(self, params):
+        infile, n_reads, out_prefix, rnd_seed, quotas = params
+        if quotas is None:
+            return self.run_once(infile, n_reads, out_prefix, rnd_seed)
 
-        
+        # a shared run of several small amplicons: simulate n_reads for each of them, then keep only what each one needs.
+        warning = self.run_once(infile, n_reads, out_prefix + "raw.", rnd_seed)
+        demultiplex_reads(out_prefix + "raw.", out_prefix, quotas)
+        return warning
 
     def run(self, amplicons, n_reads):
 
-        params = zip(amplicons, n_reads)
+        # each job is (infile, rcount, out_prefix, quotas), quotas is None unless the job is a bucket of small amplicons.
+        jobs = []
+        buckets = {}
+        for a, n in zip(amplicons, n_reads):
+            if n <= 0:
+                continue
+            if n < SMALL_RCOUNT_THRESHOLD:
+                # bucket k holds read counts in [2**(k-1), 2**k), so a shared run simulates at most twice the reads needed.
+                buckets.setdefault(int(n).bit_length(), []).append((a, n))
+            else:
+                short_name = ".".join(basename(a).split(".")[:-1])
+                jobs.append((a, n, join(self.tmpdir,"tmp.sms.")+short_name+".", None))
+
+        for k, members in sorted(buckets.items()):
+            # reads are matched back to their amplicon by id, so the ids have to be unique within the bucket.
+            quotas = {}
+            for a, n in members:
+                with open(a) as amplicon_file:
+                    for line in amplicon_file:
+                        if line.startswith(">"):
+                            amplicon_id = line[1:].split()[0]
+                            if amplicon_id in quotas:
+                                raise ValueError(f"Amplicon id {amplicon_id} (in {a}) appears more than once among the amplicons simulated together in one art_illumina run.")
+                            quotas[amplicon_id] = n
+
+            bucket_fasta = join(self.tmpdir, f"tmp.sms.bucket_{k}.fasta")
+            with open(bucket_fasta, "wb") as bucket:
+                cat_files([a for a, _ in members], bucket)
+
+            jobs.append((bucket_fasta, max(n for _, n in members), join(self.tmpdir, f"tmp.sms.bucket_{k}."), quotas))
+
+        # one child seed per art_illumina run, so the output doesn't depend on how the runs are scheduled.
+        seeds = np.random.SeedSequence(int(self.rng.integers(2 ** 63))).spawn(len(jobs))
 
-        for a, n in params:
-            
-            short_name = ".".join(basename(a).split(".")[:-1])
-            
-            if self.verbose:
-                logging.info(f"Starting on file {short_name}.fasta with {n} reads")
+        params = []
+        for (a, n, out_prefix, quotas), seed in zip(jobs, seeds):
+            rnd_seed = int(seed.generate_state(1, dtype=np.uint64)[0]) >> 1
+            params.append((a, n, out_prefix, rnd_seed, quotas))
 
-            self.run_once(a, n, join(self.temp,"tmp.sms.")+short_name+".", np.random.randint(2 ** 63))
+        with ProcessPoolExecutor(max_workers=self.max_workers) as ex:
+            for (a, n, _, _, quotas), warning in zip(params, ex.map(self._run_job, params)):
 
+                if self.verbose:
+                    if quotas is None:
+                        logging.info(f"art_illumina: simulated {n} read pairs per amplicon in {basename(a)}")
+                    else:
+                        logging.info(f"art_illumina: simulated up to {n} read pairs for each of {len(quotas)} small amplicons in one run")
+                if warning and warning != "Warning: your simulation will not output any ALN or SAM file with your parameter settings!\n":
+                    logging.warning(warning)
 
-        all_r1_files = sorted([x for x in glob.glob(join(self.temp,"tmp.sms.*")) if x[-4:] == "1.fq"])
-        all_r2_files = sorted([x for x in glob.glob(join(self.temp,"tmp.sms.*")) if x[-4:] == "2.fq"])
 
-        with open(join(self.temp,"tmp.sms.all_files_unshuffled1.fastq"), "w") as all_r1:
-            for r1 in all_r1_files:
-                with open(r1, "r") as r1fh:
-                    shutil.copyfileobj(r1fh, all_r1)
-        
-        with open(join(self.temp,"tmp.sms.all_files_unshuffled2.fastq"), "w") as all_r2:
-            for r2 in all_r2_files:
-                with open(r2, "r") as r2fh:
-                    shutil.copyfileobj(r2fh, all_r2)
+        all_r1_files = [out_prefix + "1.fq" for _, _, out_prefix, _, _ in params]
+        all_r2_files = [out_prefix + "2.fq" for _, _, out_prefix, _, _ in params]
 
-        logging.info("Creating random data for shuffle.")
-        with open(join(self.temp,"tmp.sms.random_data"), "w") as random_data:
-            ALPHABET = np.array(list(string.ascii_lowercase))
-            random_data.write("".join(np.random.choice(ALPHABET, size=max(5000000, int(2.5*self.nreads)))))
+        shuffle_seed = int(self.rng.integers(2 ** 31))
+        # terashuf's permutation also depends on its buffer size, so R1 and R2 must share the same one.
+        shuffle_memory = shuffle_memory_gb()
 
         # shuffle the fastq's so that the reads are in a random order. 
-        shuffle_fastq_file(join(self.temp,"tmp.sms.all_files_unshuffled1.fastq"), join(self.outpath, f"{self.output_filename_prefix}_R1.fastq"), join(self.temp,"tmp.sms.random_data"))
-        shuffle_fastq_file(join(self.temp,"tmp.sms.all_files_unshuffled2.fastq"), join(self.outpath, f"{self.output_filename_prefix}_R2.fastq"), join(self.temp,"tmp.sms.random_data"))
+        extension = "fastq.gz" if self.compress else "fastq"
+        shuffle_fastq_file(all_r1_files, join(self.outpath, f"{self.output_filename_prefix}_R1.{extension}"), shuffle_seed, shuffle_memory, self.tmpdir, self.compress, self.max_workers)
+        shuffle_fastq_file(all_r2_files, join(self.outpath, f"{self.output_filename_prefix}_R2.{extension}"), shuffle_seed, shuffle_memory, self.tmpdir, self.compress, self.max_workers)
 
 
-def shuffle_fastq_file(input_filename, output_filename, random_seed):
+def demultiplex_reads(in_prefix, out_prefix, quotas):
+    # art_illumina names reads "<amplicon id>-<read number>/<mate>". Keep the first quotas[id] pairs of each amplicon.
+    kept = dict.fromkeys(quotas, 0)
+    with open(in_prefix + "1.fq") as in1, open(in_prefix + "2.fq") as in2, \
+            open(out_prefix + "1.fq", "w") as out1, open(out_prefix + "2.fq", "w") as out2:
+        for record1, record2 in zip(zip(in1, in1, in1, in1), zip(in2, in2, in2, in2)):
+            source = record1[0][1:].rsplit("-", 1)[0]
+            if source not in quotas:
+                raise ValueError(f"Read {record1[0].strip()} in {in_prefix}1.fq does not match any amplicon id of its art_illumina run, "
+                                 "expected read names of the form <amplicon id>-<read number>/<mate>.")
+            if kept[source] < quotas[source]:
+                kept[source] += 1
+                out1.writelines(record1)
+                out2.writelines(record2)
+
+    os.remove(in_prefix + "1.fq")
+    os.remove(in_prefix + "2.fq")
+
+def cat_files(input_files, output, chunk_size=1000):
+    # concatenate with cat rather than copying through python. The files are passed in chunks to stay under ARG_MAX.
+    output.flush()
+    for i in range(0, len(input_files), chunk_size):
+        subprocess.run(["cat", *input_files[i:i + chunk_size]], stdout=output, check=True)
+
+def shuffle_memory_gb(max_gb=8, fallback_gb=2):
+    # terashuf buffer size: half of the free memory, capped at max_gb.
+    # SC_AVPHYS_PAGES is not available everywhere (e.g. macOS), use a fixed budget there.
+    try:
+        available = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError):
+        return float(fallback_gb)
+    return max(min(available / 2, max_gb * 2 ** 30), 2 ** 28) / 2 ** 30
+
+def write_random_stream(path, seed, chunk_size=2 ** 20):
+    # write an endless stream of seeded random bytes to the fifo at path, until the reader closes it.
+    rng = np.random.default_rng(seed)
+    try:
+        with open(path, "wb", buffering=0) as fifo:
+            while True:
+                fifo.write(rng.bytes(chunk_size))
+    except BrokenPipeError:
+        pass
+
+def shuffle_fastq_file(input_files, output_filename, seed, memory_gb, temp, compress=False, compress_threads=None):
     logging.info(f"Shuffling {output_filename}")
-    # additionally, this changes all '&' characters back to '/' characters. 
-    os.system(f"paste -s -d '\t\t\t\n' {input_filename} | shuf --random-source={random_seed} | tr '\t&' '\n/' > {output_filename}")
+    # the input files are streamed straight into the pipeline, so no unshuffled copy is written to disk.
+    # terashuf is used when installed, since it shuffles inputs larger than memory, shuf is the fallback.
+    # mates have the same record lengths, so both terashuf and shuf give R1 and R2 the same permutation
+    # for the same seed (and, for terashuf, the same memory_gb buffer size).
+    # if compress is set, the output is gzipped on the way out with pigz, using compress_threads threads (all CPUs if None),
+    # or with gzip if pigz is missing.
+    env = None
+    random_source = None
+    writer = None
+    pipeline = []
+    read_end, write_end = os.pipe()
+    pipe_in, pipe_out = open(read_end, "rb"), open(write_end, "wb")
+    try:
+        if shutil.which("terashuf") is not None:
+            shuffler = ["terashuf"]
+            env = dict(os.environ, SEED=str(seed), MEMORY=f"{memory_gb:.2f}", TMPDIR=temp)
+        else:
+            # shuf reads its randomness from a fifo fed by a seeded generator, so nothing is written to disk.
+            # the fifo lives in its own directory on /dev/shm when there is one, rather than on a (possibly network) temp folder,
+            # so concurrent shuffles and runs never share it. It is outside temp, so it is always removed below.
+            random_source = join(tempfile.mkdtemp(prefix="tmp.sms.", dir="/dev/shm" if os.path.isdir("/dev/shm") else temp), "random_source")
+            os.mkfifo(random_source)
+            writer = threading.Thread(target=write_random_stream, args=(random_source, seed), daemon=True)
+            writer.start()
+            shuffler = ["shuf", "--random-source", random_source]
+
+        # paste | shuffler | tr [| pigz], with each stage its own process connected by pipes (no shell).
+        with open(output_filename, "wb") as output:
+            pipeline.append(subprocess.Popen(["paste", "-s", "-d", "\t\t\t\n", "-"], stdin=pipe_in, stdout=subprocess.PIPE))
+            pipeline.append(subprocess.Popen(shuffler, stdin=pipeline[-1].stdout, stdout=subprocess.PIPE, env=env))
+            if not compress:
+                pipeline.append(subprocess.Popen(["tr", "\t", "\n"], stdin=pipeline[-1].stdout, stdout=output))
+            else:
+                pipeline.append(subprocess.Popen(["tr", "\t", "\n"], stdin=pipeline[-1].stdout, stdout=subprocess.PIPE))
+                if shutil.which("pigz") is not None:
+                    compressor = ["pigz", "-p", str(compress_threads or os.cpu_count())]
+                else:
+                    compressor = ["gzip"]
+                pipeline.append(subprocess.Popen(compressor, stdin=pipeline[-1].stdout, stdout=output))
+        pipe_in.close()
+        for p in pipeline[:-1]:
+            p.stdout.close()
+
+        cat_files(input_files, pipe_out)
+        pipe_out.close()
+
+    except BaseException:
+        for p in pipeline:
+            p.kill()
+        raise
+
+    finally:
+        pipe_in.close()
+        pipe_out.close()
+        for p in pipeline:
+            if p.stdout is not None:
+                p.stdout.close()
+            p.wait()
+
+        if writer is not None:
+            # unblock the writer in case shuf exited without opening the fifo. The writer may only reach its open() after
+            # we've opened and closed our end, so keep doing it until the thread has finished.
+            while writer.is_alive():
+                os.close(os.open(random_source, os.O_RDONLY | os.O_NONBLOCK))
+                writer.join(0.1)
+        if random_source is not None:
+            shutil.rmtree(dirname(random_source), ignore_errors=True)
+
+    for p in pipeline:
+        if p.returncode != 0:
+            raise subprocess.CalledProcessError(p.returncode, p.args)
 
 @contextmanager
-def art_illumina(outpath, output_filename_prefix, read_length, seq_sys, verbose,temp, nreads):
+def art_illumina(outpath, output_filename_prefix, read_length, seq_sys, verbose,temp, nreads, max_workers=None, compress=True, rng=None):
     
+    art = ArtIllumina(outpath, output_filename_prefix, read_length, seq_sys, verbose,temp, nreads, max_workers, compress, rng)
     try:
-        yield ArtIllumina(outpath, output_filename_prefix, read_length, seq_sys, verbose,temp, nreads)
+        yield art
     
     finally:
         logging.info("Exiting sars-cov-2 metagenome simulator - tidying up.")
 
-        for tem in glob.glob(join(temp,"tmp.sms.*")):
-            os.remove(tem)
+        shutil.rmtree(art.tmpdir, ignore_errors=True)
@@ -6,11 +6,11 @@ import pandas as pd
 import logging
 
 
-def build_index(genome_path, genome_filename_short, indices_folder):
+def build_index(genome_path, genome_filename_short, indices_folder, threads=1):
     
     # create bowtie2 index for the reference
     subprocess.run([
-        "bowtie2-build", genome_path, join(indices_folder, genome_filename_short)], stdout=subprocess.DEVNULL)
+        "bowtie2-build", "--threads", str(threads), genome_path, join(indices_folder, genome_filename_short)], stdout=subprocess.DEVNULL)
 
 def align_primers(genome_path, genome_filename_short, indices_folder, primers_files, verbose):
 
@@ -80,10 +80,12 @@ def align_primers(genome_path, genome_filename_short, indices_folder, primers_fi
 
 def write_amplicon(df, reference, genome_filename_short, amplicons_folder, verbose=False):
 
+        # convert the sequence to a string once, then every amplicon is a plain string slice
+        reference_string = str(reference.seq)
+
         for r in df.itertuples():
             amplicon_number = r.amplicon_number
             alt = r.is_alt
-            reference_string = str(reference.seq)
             amplicon = reference_string[r.left - 1: r.right + r.right_primer_length - 1]
             
             if verbose:
@@ -94,8 +96,7 @@ def write_amplicon(df, reference, genome_filename_short, amplicons_folder, verbo
 
             with open(f"{amplicons_folder}/{genome_filename_short}_amplicon_{amplicon_number}" + ("_alt" if alt else "") + ".fasta", "w") as f:
 
-                f.write(f">{reference.id}_amplicon_{amplicon_number}" + ("_alt" if alt else "") + "\n")
-                f.write(amplicon + "\n\n")
+                f.write(f">{reference.id}_amplicon_{amplicon_number}" + ("_alt" if alt else "") + "\n" + amplicon + "\n\n")
 
 
 if __name__=="__main__":
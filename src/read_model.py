@@ -1,10 +1,12 @@
-from numpy.random import dirichlet, binomial, multinomial
 import numpy as np
 import pandas as pd
 import logging
 
 
-def get_amplicon_reads_sampler(amplicon_distribution, amplicon_distribution_file, amplicon_pseudocounts_c, genome_abundances, total_n_reads):
+def get_amplicon_reads_sampler(amplicon_distribution, amplicon_distribution_file, amplicon_pseudocounts_c, genome_abundances, total_n_reads, rng=None):
+
+    if rng is None:
+        rng = np.random.default_rng()
     
     if amplicon_distribution.upper() == "EXACT":
 
@@ -13,83 +15,84 @@ def get_amplicon_reads_sampler(amplicon_distribution, amplicon_distribution_file
             genome_names = adf.readline().split("\t")
             amplicon_distribution_dict = {g: [] for g in genome_names}
 
-        def hyperparam_sampler(dataframe_row):
-            return -1
+        def hyperparam_sampler(df):
+            return np.full(len(df), -1)
 
-        def genome_count_sampler(dataframe_row):
-            return -1
+        def genome_count_sampler(df):
+            return np.full(len(df), -1)
 
-        def prob_sampler(dataframe_row):
-            return -1
+        def prob_sampler(df):
+            return np.full(len(df), -1)
 
-        def reads_sampler(dataframe_row):
+        def reads_sampler(df):
             nonlocal amplicon_distribution_dict
-            return amplicon_distribution_dict[dataframe_row.ref][dataframe_row.amplicon_number - 1]
+            return np.array([amplicon_distribution_dict[ref][n - 1] for ref, n in zip(df["ref"], df["amplicon_number"])])
 
 
     elif amplicon_distribution.upper() == "DIRICHLET_1":
 
 
-        genome_counts = multinomial(total_n_reads, [genome_abundances[i] for i in sorted(genome_abundances.keys())])
+        genome_counts = rng.multinomial(total_n_reads, [genome_abundances[i] for i in sorted(genome_abundances.keys())])
         genome_counts = {k:genome_counts[i] for i,k in enumerate(sorted(genome_abundances.keys()))}
         
         hyperparams = pd.read_csv(amplicon_distribution_file, sep="\t")
         hyperparams = {t.amplicon_number:t.hyperparameter for t in hyperparams.itertuples()}
-        probs = dirichlet(np.array([hyperparams[i] for i in sorted(hyperparams.keys())], dtype=float) * float(amplicon_pseudocounts_c))
+        probs = rng.dirichlet(np.array([hyperparams[i] for i in sorted(hyperparams.keys())], dtype=float) * float(amplicon_pseudocounts_c))
+        
+        amplicon_counts = {ref:rng.multinomial(genome_counts[ref], probs) for ref in genome_abundances.keys()}
         
-        amplicon_counts = {ref:multinomial(genome_counts[ref], probs) for ref in genome_abundances.keys()}
+        # one row of amplicon counts per genome, so the reads can be looked up with a single fancy index
+        genome_index = {ref:i for i, ref in enumerate(amplicon_counts.keys())}
+        amplicon_counts = np.vstack(list(amplicon_counts.values()))
 
 
-        def hyperparam_sampler(dataframe_row):
+        def hyperparam_sampler(df):
             nonlocal hyperparams
-            return hyperparams[dataframe_row.amplicon_number]
+            return df["amplicon_number"].map(hyperparams).to_numpy()
 
-        def genome_count_sampler(dataframe_row):
+        def genome_count_sampler(df):
             nonlocal genome_counts
-            return genome_counts[dataframe_row.ref]
+            return df["ref"].map(genome_counts).to_numpy()
         
-        def prob_sampler(dataframe_row):
+        def prob_sampler(df):
             nonlocal probs
-            p = probs[dataframe_row.amplicon_number - 1]
-            return p
+            return probs[df["amplicon_number"].to_numpy() - 1]
 
-        def reads_sampler(dataframe_row):
-            d = dataframe_row
-            return amplicon_counts[d.ref][d.amplicon_number - 1]
+        def reads_sampler(df):
+            return amplicon_counts[df["ref"].map(genome_index).to_numpy(), df["amplicon_number"].to_numpy() - 1]
 
     elif amplicon_distribution.upper() == "DIRICHLET_2":
         
         genomes_list = {}
-        genome_counts = multinomial(total_n_reads, [genome_abundances[i] for i in sorted(genome_abundances.keys())])
+        genome_counts = rng.multinomial(total_n_reads, [genome_abundances[i] for i in sorted(genome_abundances.keys())])
         genome_counts = {k:genome_counts[i] for i, k in enumerate(sorted(genome_abundances.keys()))}
 
         hyperparams = pd.read_csv(amplicon_distribution_file, sep="\t")
         hyperparams = {t.amplicon_number:t.hyperparameter for t in hyperparams.itertuples()}
         hyperparams = np.array([hyperparams[i] for i in sorted(hyperparams.keys())], dtype=float)
         
-        def hyperparam_sampler(dataframe_row):
+        def hyperparam_sampler(df):
             nonlocal hyperparams
-            return hyperparams[dataframe_row.amplicon_number - 1]
+            return hyperparams[df["amplicon_number"].to_numpy() - 1]
 
-        def genome_count_sampler(dataframe_row):
+        def genome_count_sampler(df):
             nonlocal genome_counts
-            return genome_counts[dataframe_row.ref]
+            return df["ref"].map(genome_counts).to_numpy()
         
-        def prob_sampler(dataframe_row):
+        def prob_sampler(df):
             nonlocal genomes_list
             nonlocal hyperparams
-            nonlocal amplicon_pseudocounts_c
-            if type(amplicon_pseudocounts_c) == float:
-                amplicon_pseudocounts_c = [amplicon_pseudocounts_c for i in range(len(genomes_list))]
-            if not dataframe_row.ref in genomes_list:
-                genomes_list[dataframe_row.ref] = dirichlet(amplicon_pseudocounts_c * hyperparams)
-
-            p = genomes_list[dataframe_row.ref][dataframe_row.amplicon_number - 1]
-            return p
+            # one dirichlet draw per genome, in the order the genomes first appear
+            for ref in pd.unique(df["ref"]):
+                if not ref in genomes_list:
+                    genomes_list[ref] = rng.dirichlet(float(amplicon_pseudocounts_c) * hyperparams)
+
+            genome_probs = np.vstack([genomes_list[ref] for ref in genomes_list.keys()])
+            genome_index = {ref:i for i, ref in enumerate(genomes_list.keys())}
+            return genome_probs[df["ref"].map(genome_index).to_numpy(), df["amplicon_number"].to_numpy() - 1]
         
-        def reads_sampler(dataframe_row):
-            d = dataframe_row
-            return binomial(round(d.total_n_reads * d.abundance), d.amplicon_prob)
+        def reads_sampler(df):
+            return rng.binomial(np.round(df["total_n_reads"].to_numpy() * df["abundance"].to_numpy()).astype(int), df["amplicon_prob"].to_numpy())
 
     else:
         logging.info("Amplicon distribution not recognised, pick one of EXACT, DIRICHLET_1, DIRICHLET_2.")
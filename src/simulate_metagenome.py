@@ -10,6 +10,8 @@ import pandas as pd
 import numpy as np
 import random
 import shutil
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
 from art_runner import art_illumina
 from create_amplicons import build_index, align_primers, write_amplicon
@@ -29,9 +31,12 @@ OUTPUT_FILENAME_PREFIX = "example"
 N_READS = 100000
 READ_LENGTH = 250
 SEQ_SYS = "MSv3"
-SEED = np.random.randint(1000000000)
+SEED = np.random.default_rng().integers(1000000000)
+RNG = np.random.default_rng(SEED)
 AMPLICON_DISTRIBUTION = "DIRICHLET_1"
 AMPLICON_PSEUDOCOUNTS = 200
+MAX_WORKERS = os.cpu_count()
+COMPRESS = True
 
 
 ##PCR-error related variables:
@@ -76,6 +81,8 @@ def setup_parser():
     parser.add_argument("--quiet", "-q", help="Add this flag to supress verbose output." ,action='store_true')
     parser.add_argument("--amplicon_distribution",help= "Default is DIRICHLET1", metavar='', default=AMPLICON_DISTRIBUTION)
     parser.add_argument("--amplicon_pseudocounts","-c", metavar='', default=AMPLICON_PSEUDOCOUNTS)
+    parser.add_argument("--max_workers", "-j", metavar='', help="Maximum number of bowtie2 and art_illumina processes to run in parallel. Default is the number of CPUs.", default=MAX_WORKERS)
+    parser.add_argument("--no_compress", action='store_true', help="Write plain fastq files. By default the output fastq files are gzipped (with pigz if available).")
     parser.add_argument("--autoremove", action='store_true',help="Delete temproray files after execution.")
     parser.add_argument("--no_pcr_errors", action='store_true',help="Turn off PCR errors. The output will contain only sequencing errors. Other PCR-error related options will be ignored")
     parser.add_argument("--unique_insertion_rate","-ins", metavar='', help="PCR insertion error rate. Unique to one source genome in the mixture Default is 0.00002", default=U_INS_RATE)
@@ -173,7 +180,8 @@ def load_command_line_args():
 
     global SEED
     SEED = args.seed
-    np.random.seed(int(SEED))
+    global RNG
+    RNG = np.random.default_rng(int(SEED))
     random.seed(int(SEED))
     logging.info(f"Random seed: {SEED}")
 
@@ -199,6 +207,12 @@ def load_command_line_args():
     AMPLICON_PSEUDOCOUNTS = int(args.amplicon_pseudocounts)
     logging.info(f"Amplicon pseudocounts/ i.e. quality parameter: {AMPLICON_PSEUDOCOUNTS}")
 
+    global MAX_WORKERS
+    MAX_WORKERS = int(args.max_workers)
+
+    global COMPRESS
+    COMPRESS = not args.no_compress
+
     global AUTOREMOVE
     AUTOREMOVE = args.autoremove
 
@@ -291,6 +305,27 @@ def load_command_line_args():
     else:
         R_DEL_VAF_DIRICLET_PARAMETER=[float(a) for a in R_DEL_VAF_DIRICLET_PARAMETER]
 
+def process_genome(genome_path, genome_counter, genome_abundances, n_genomes, genomes_folder, indices_folder, amplicons_folder, primers_file, verbose):
+    # align the primers to one genome and write out its amplicons. Runs in a worker process, so everything is passed in.
+    genome_path = genome_path.replace(" ", "_").replace("/", "&").replace(",", "&") + ".fasta"
+    genome_path = join(genomes_folder, genome_path)
+    genome_filename_short = ".".join(basename(genome_path).split(".")[:-1])
+    reference = SeqIO.read(genome_path, format="fasta")
+
+    # use bowtie2 to create a dataframe with positions of each primer pair aligned to the genome
+    if verbose:
+        logging.info(f"Working on genome {genome_counter} of {n_genomes}")
+        logging.info(f"Using bowtie2 to align primers to genome {reference.description}")
+
+    # one bowtie2-build thread per worker, the parallelism comes from the pool
+    build_index(genome_path, genome_filename_short, indices_folder, threads=1)
+    df = align_primers(genome_path, genome_filename_short, indices_folder, primers_file, False)        
+    df["abundance"] = genome_abundances[df["ref"][0]]
+
+    # write the amplicon to a file
+    write_amplicon(df, reference, genome_filename_short, amplicons_folder)
+    return df
+
 
 if __name__ == "__main__":
 
@@ -308,7 +343,6 @@ if __name__ == "__main__":
 
     # Read genome abundances csv file
     genome_abundances = {}
-    df_amplicons = pd.DataFrame()
 
     with open(ABUNDANCES_FILE2) as ab_file:
         for line in ab_file:
@@ -329,36 +363,38 @@ if __name__ == "__main__":
 
     n_genomes = len(genome_abundances)
 
-    # Split genome file into multiple separate files
-    for genome in SeqIO.parse(GENOMES_FILE2, format="fasta"):
-        filepath = genome.description.replace(" ", "&").replace("/", "&").replace(",", "&")
-        filepath += ".fasta"
-        SeqIO.write(genome, join(GENOMES_FOLDER, filepath), format="fasta")
+    # Split genome file into multiple separate files, copying the records line by line without parsing them
+    with open(GENOMES_FILE2) as genomes_fh:
+        genome_out = None
+        for line in genomes_fh:
+            if line.startswith(">"):
+                if genome_out:
+                    genome_out.close()
+                filepath = line[1:].strip().replace(" ", "&").replace("/", "&").replace(",", "&")
+                filepath += ".fasta"
+                genome_out = open(join(GENOMES_FOLDER, filepath), "w")
+            if genome_out:
+                genome_out.write(line)
+        if genome_out:
+            genome_out.close()
 
 
     # STEP 2: Simulate Amplicon Population
-    genome_counter = 0
-    for genome_path in genome_abundances:
-        genome_counter += 1
-        genome_path = genome_path.replace(" ", "_").replace("/", "&").replace(",", "&") + ".fasta"
-        genome_path = join(GENOMES_FOLDER, genome_path)
-        genome_filename_short = ".".join(basename(genome_path).split(".")[:-1])
-        reference = SeqIO.read(genome_path, format="fasta")
-
-        # use bowtie2 to create a dataframe with positions of each primer pair aligned to the genome
-        if VERBOSE:
-            logging.info(f"Working on genome {genome_counter} of {n_genomes}")
-            logging.info(f"Using bowtie2 to align primers to genome {reference.description}")
-
-        build_index(genome_path, genome_filename_short, INDICES_FOLDER)
-        df = align_primers(genome_path, genome_filename_short, INDICES_FOLDER, PRIMERS_FILE, False)        
-        df["abundance"] = genome_abundances[df["ref"][0]]
-
-        # write the amplicon to a file
-        write_amplicon(df, reference, genome_filename_short, AMPLICONS_FOLDER)
-
-
-        df_amplicons = pd.concat([df_amplicons, df])
+    # the genomes are independent, so the bowtie2 runs for each of them are spread over a process pool
+    with ProcessPoolExecutor(max_workers=max(1, min(MAX_WORKERS, n_genomes))) as ex:
+        amplicon_dfs = list(ex.map(
+            partial(process_genome, 
+                    genome_abundances=genome_abundances, 
+                    n_genomes=n_genomes, 
+                    genomes_folder=GENOMES_FOLDER, 
+                    indices_folder=INDICES_FOLDER, 
+                    amplicons_folder=AMPLICONS_FOLDER, 
+                    primers_file=PRIMERS_FILE, 
+                    verbose=VERBOSE),
+            genome_abundances.keys(),
+            range(1, n_genomes + 1)))
+
+    df_amplicons = pd.concat(amplicon_dfs, ignore_index=True)
 
 
     # pick total numbers of reads for each amplicon
@@ -367,22 +403,28 @@ if __name__ == "__main__":
                                 AMPLICON_DISTRIBUTION_FILE, 
                                 AMPLICON_PSEUDOCOUNTS, 
                                 genome_abundances,
-                                N_READS)
+                                N_READS,
+                                RNG)
 
-    df_amplicons["total_n_reads"] = N_READS
+    # the sampled columns are built as typed numpy arrays (int64 counts, float64 probabilities) and added with assign,
+    # so none of them end up as object columns.
+    n_amplicons = len(df_amplicons)
+    df_amplicons = df_amplicons.assign(total_n_reads=np.full(n_amplicons, N_READS, dtype=np.int64))
 
     # for each amplicon, look up what the dirichlet hyperparameter should be (parameter \alpha)
-    df_amplicons["hyperparameter"] = df_amplicons.apply(amplicon_hyperparameter_sampler, axis=1)
+    hyperparameter = np.asarray(amplicon_hyperparameter_sampler(df_amplicons), dtype=np.float64)
 
     # for each genome, sample a total number of reads that should be shared between all of its amplicons
     # N_genome = Multinomial(N_reads, p_genomes)
-    df_amplicons["genome_n_reads"] = df_amplicons.apply(genome_count_sampler, axis=1)
+    genome_n_reads = np.asarray(genome_count_sampler(df_amplicons), dtype=np.int64)
 
     # sample a p_amplicon vector from the dirichlet distribution - p_amplicon = Dir(\alpha)
-    df_amplicons["amplicon_prob"] = df_amplicons.apply(amplicon_probability_sampler, axis=1)
+    amplicon_prob = np.asarray(amplicon_probability_sampler(df_amplicons), dtype=np.float64)
+
+    df_amplicons = df_amplicons.assign(hyperparameter=hyperparameter, genome_n_reads=genome_n_reads, amplicon_prob=amplicon_prob)
 
     # sample a number of reads for the amplicons of each genome: Multinomial(N_genome, p_amplicon)
-    df_amplicons["n_reads"] = df_amplicons.apply(amplicon_reads_sampler, axis=1)
+    df_amplicons = df_amplicons.assign(n_reads=np.asarray(amplicon_reads_sampler(df_amplicons), dtype=np.int64))
 
     # write a summary csv
     df_amplicons[
@@ -396,10 +438,8 @@ if __name__ == "__main__":
         "amplicon_prob",
         "n_reads"]].to_csv(join(OUTPUT_FOLDER, f"{OUTPUT_FILENAME_PREFIX}_amplicon_abundances_summary.tsv"), sep="\t")
 
-    df_amplicons.reset_index(drop=True,inplace=True)
-
     if VERBOSE:
-        logging.info(f"Total number of reads was {sum(df_amplicons['n_reads'])}, when {N_READS} was expected.")
+        logging.info(f"Total number of reads was {df_amplicons['n_reads'].sum()}, when {N_READS} was expected.")
 
 
     # STEP 3: Library Prep - PCR Amplification of Amplicons
@@ -414,7 +454,7 @@ if __name__ == "__main__":
         amplicons,n_reads,vcf_errordf=add_PCR_errors(df_amplicons,genome_abundances,PRIMER_BED,WUHAN_REF,AMPLICONS_FOLDER,
                                             U_SUBS_RATE,U_INS_RATE,U_DEL_RATE,R_SUBS_RATE,R_INS_RATE,R_DEL_RATE,DEL_LENGTH_GEOMETRIC_PARAMETER,INS_MAX_LENGTH,
                                             SUBS_VAF_DIRICLET_PARAMETER,INS_VAF_DIRICLET_PARAMETER,DEL_VAF_DIRICLET_PARAMETER,
-                                            R_SUBS_VAF_DIRICLET_PARAMETER,R_INS_VAF_DIRICLET_PARAMETER,R_DEL_VAF_DIRICLET_PARAMETER)
+                                            R_SUBS_VAF_DIRICLET_PARAMETER,R_INS_VAF_DIRICLET_PARAMETER,R_DEL_VAF_DIRICLET_PARAMETER,RNG)
                
         if amplicons=="No":
             if VERBOSE:
@@ -430,13 +470,12 @@ if __name__ == "__main__":
                 o.write('##INFO=<ID=VAF,Number=A,Type=Float,Description="Variant Allele Frequency">\n')
                 o.write('##INFO=<ID=REC,Number=A,Type=String,Description="Recurrence state across source genomes. R: recurrent; U: unique to genome">\n')
                 o.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+                vcf_errordf.to_csv(o, header=False,index=False,sep="\t", float_format='%.5f')
 
-            vcf_errordf.to_csv(f"{OUTPUT_FOLDER}/{OUTPUT_FILENAME_PREFIX}_PCR_errors.vcf",
-                                mode="a",header=False,index=False,sep="\t", float_format='%.5f')
             if VERBOSE:
                 logging.info(f'All aimed PCR errros are written to "{OUTPUT_FOLDER}/{OUTPUT_FILENAME_PREFIX}_PCR_errors.vcf"')
     
-    amplicons = [join(AMPLICONS_FOLDER, a) for a in amplicons]
+    amplicons = np.char.add(AMPLICONS_FOLDER + os.sep, np.asarray(amplicons, dtype=str)).tolist()
 
     #merge art_illumina runs which have the same read count to optimize
 
@@ -453,7 +492,7 @@ if __name__ == "__main__":
     
     # STEP 4: Simulate Reads
     logging.info("Generating reads using art_illumina, cycling through all genomes and remaining amplicons.")
-    with art_illumina(OUTPUT_FOLDER, OUTPUT_FILENAME_PREFIX, READ_LENGTH, SEQ_SYS,VERBOSE,TEMP_FOLDER,N_READS) as art:
+    with art_illumina(OUTPUT_FOLDER, OUTPUT_FILENAME_PREFIX, READ_LENGTH, SEQ_SYS,VERBOSE,TEMP_FOLDER,N_READS,MAX_WORKERS,COMPRESS,RNG) as art:
         art.run(merged_amplicons, merged_n_reads)
 
     # STEP 5: Clean up all of the temp. directories
@@ -0,0 +1,58 @@
+import os
+import shutil
+import subprocess
+import sys
+import threading
+from os.path import abspath, dirname, join
+
+import pytest
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), "src"))
+
+from art_runner import shuffle_fastq_file
+
+
+def write_fastq(path, n_reads, mate):
+    with open(path, "w") as fq:
+        for i in range(n_reads):
+            fq.write(f"@g_amplicon_1-{i}/{mate}\nACGT\n+\nIIII\n")
+
+
+@pytest.mark.skipif(shutil.which("shuf") is None or shutil.which("terashuf") is not None,
+                    reason="needs GNU shuf as the shuffler")
+def test_shuffle_with_missing_input_raises_and_cleans_up(tmp_path):
+    # cat fails on the missing file. This used to leave the fifo writer blocked in open() forever.
+    write_fastq(tmp_path / "a.1.fq", 100, 1)
+    shm_before = set(os.listdir("/dev/shm")) if os.path.isdir("/dev/shm") else set()
+
+    errors = []
+    def shuffle():
+        try:
+            shuffle_fastq_file([str(tmp_path / "a.1.fq"), str(tmp_path / "missing.fq")],
+                               str(tmp_path / "out.fq"), 7, 1.0, str(tmp_path))
+        except Exception as e:
+            errors.append(e)
+
+    for _ in range(5):
+        errors.clear()
+        thread = threading.Thread(target=shuffle, daemon=True)
+        thread.start()
+        thread.join(30)
+        assert not thread.is_alive(), "shuffle_fastq_file hung on a missing input file"
+        assert len(errors) == 1 and isinstance(errors[0], subprocess.CalledProcessError)
+
+    shm_after = set(os.listdir("/dev/shm")) if os.path.isdir("/dev/shm") else set()
+    assert not [d for d in shm_after - shm_before if d.startswith("tmp.sms.")]
+
+
+@pytest.mark.skipif(shutil.which("shuf") is None or shutil.which("terashuf") is not None,
+                    reason="needs GNU shuf as the shuffler")
+def test_shuffle_keeps_mates_paired(tmp_path):
+    for mate in (1, 2):
+        write_fastq(tmp_path / f"a.{mate}.fq", 500, mate)
+        shuffle_fastq_file([str(tmp_path / f"a.{mate}.fq")], str(tmp_path / f"out{mate}.fq"), 7, 1.0, str(tmp_path))
+
+    names1 = [line[:-3] for line in open(tmp_path / "out1.fq") if line.startswith("@")]
+    names2 = [line[:-3] for line in open(tmp_path / "out2.fq") if line.startswith("@")]
+    assert len(names1) == 500
+    assert names1 == names2